@@ -15,25 +15,62 @@ Auteur  : Marius Mézerette - GAPRA / Observatoire R85 — Antibes
 Licence : MIT
 """
 
+import concurrent.futures
+import contextlib
+import io
 import json
 import math
 import urllib.request
 import urllib.error
 import urllib.parse
 import datetime
+import http.client
 import os
+import sqlite3
 import sys
 import subprocess
 import platform
+import re
+from typing import NamedTuple, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy est optionnel : sans lui, la grille temporelle est une simple liste.
+    np = None
+
+try:
+    from numba import njit
+    _JIT = True
+except ImportError:
+    # numba est optionnel : sans lui, les fonctions restent en Python pur.
+    _JIT = False
+
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+# NumPy sans numba : boucles de la grille remplacées par des calculs vectorisés
+_VECTORIZE = np is not None and not _JIT
+
+try:
+    import urllib3
+except ImportError:
+    # urllib3 est optionnel : sans lui, repli sur urllib (sans keep-alive).
+    urllib3 = None
 
 # ─── Fichiers ──────────────────────────────────────────────────────────────
 SCRIPT_DIR  = os.path.dirname(os.path.abspath(__file__))
 CONFIG_FILE = os.path.join(SCRIPT_DIR, "config.json")
-STATE_FILE  = os.path.join(SCRIPT_DIR, "state.json")
+STATE_DB    = os.path.join(SCRIPT_DIR, "state.db")
+STATE_FILE  = os.path.join(SCRIPT_DIR, "state.json")   # ancien format, importé une fois
 ALERT_FILE  = os.path.join(SCRIPT_DIR, "alert_pending.json")
 FLAG_FILE   = os.path.join(SCRIPT_DIR, "heartbeat_alert.flag")
+SUN_CACHE   = os.path.join(SCRIPT_DIR, "sun_cache.json")
 PCCP_URL    = "https://www.minorplanetcenter.net/iau/NEO/pccp.txt"
 PCCP_PAGE   = "https://www.minorplanetcenter.net/iau/NEO/pccp_tabular.html"
+USER_AGENT  = "CometWatch-R85/1.1"
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -76,9 +113,25 @@ def load_config() -> dict:
 
 # ═══════════════════════════════════════════════════════════════════════════
 # Calculs astronomiques (pure Python — aucune dépendance externe)
+# Les fonctions @njit sont compilées par numba s'il est installé ; sans lui,
+# NumPy (s'il est présent) vectorise les calculs sur la grille temporelle.
 # ═══════════════════════════════════════════════════════════════════════════
 
+_J2000           = 2451545.0                 # JD de l'époque J2000.0
+_INV_CENTURY     = 1.0 / 36525.0             # jours → siècles juliens
+_INV_GMST_CUBIC  = 1.0 / 38710000.0          # terme T³ du GMST
+_GMST_RATE       = 360.98564736629           # degrés sidéraux par jour
+_SUN_L_RATE      = 0.9856474                 # longitude moyenne (°/jour)
+_SUN_G_RATE      = 0.9856003                 # anomalie moyenne (°/jour)
+_OBLIQUITY_J2000 = math.radians(23.439)      # obliquité de l'écliptique (rad)
+_OBLIQUITY_RATE  = math.radians(4e-7)        # dérive de l'obliquité (rad/jour)
+
+
+@njit(cache=True)
 def _r(d): return d * math.pi / 180.0
+
+
+@njit(cache=True)
 def _d(r): return r * 180.0 / math.pi
 
 
@@ -93,15 +146,16 @@ def julian_day(dt: datetime.datetime) -> float:
     return jdn + frac
 
 
+@njit(cache=True)
 def gmst_deg(jd: float) -> float:
     """Temps Sidéral Moyen de Greenwich (degrés)."""
-    T = (jd - 2451545.0) / 36525.0
-    return (280.46061837
-            + 360.98564736629 * (jd - 2451545.0)
-            + 0.000387933 * T * T
-            - T ** 3 / 38710000.0) % 360.0
+    n = jd - _J2000
+    T = n * _INV_CENTURY
+    return (280.46061837 + _GMST_RATE * n
+            + T * T * (0.000387933 - T * _INV_GMST_CUBIC)) % 360.0
 
 
+@njit(cache=True)
 def altitude(ra_h: float, dec_d: float, jd: float,
              lat: float, lon: float) -> float:
     """
@@ -119,143 +173,472 @@ def altitude(ra_h: float, dec_d: float, jd: float,
     return _d(math.asin(max(-1.0, min(1.0, sin_h))))
 
 
+@njit(cache=True)
 def sun_pos(jd: float):
     """Position approx du Soleil (RA heures, Dec degrés). Précision ~1°."""
-    n = jd - 2451545.0
-    L = (280.460 + 0.9856474 * n) % 360.0
-    g = _r((357.528 + 0.9856003 * n) % 360.0)
+    n = jd - _J2000
+    L = (280.460 + _SUN_L_RATE * n) % 360.0
+    g = _r((357.528 + _SUN_G_RATE * n) % 360.0)
     lam = _r(L + 1.915 * math.sin(g) + 0.020 * math.sin(2 * g))
-    eps = _r(23.439 - 4e-7 * n)
+    eps = _OBLIQUITY_J2000 - _OBLIQUITY_RATE * n
     ra  = _d(math.atan2(math.cos(eps) * math.sin(lam), math.cos(lam))) / 15.0
     dec = _d(math.asin(math.sin(eps) * math.sin(lam)))
     return (ra % 24.0), dec
 
 
+@njit(cache=True)
 def sun_alt(jd: float, lat: float, lon: float) -> float:
     ra, dec = sun_pos(jd)
     return altitude(ra, dec, jd, lat, lon)
 
 
-def observable_window(ra_h: float, dec_d: float, jd0: float,
-                      lat: float, lon: float,
+@njit(cache=True)
+def altitude_fast(ra_h: float, dec_d: float, lst_deg: float,
+                  sin_lat: float, cos_lat: float, dec_cache=None) -> float:
+    """
+    Comme altitude(), à partir du temps sidéral local (degrés) déjà calculé.
+    dec_cache : (sin(dec), cos(dec)) précalculés pour l'objet, optionnel.
+    """
+    if dec_cache is None:
+        dec_r = _r(dec_d)
+        dec_cache = (math.sin(dec_r), math.cos(dec_r))
+    sin_dec, cos_dec = dec_cache
+    ha = _r((lst_deg - ra_h * 15.0) % 360.0)
+    sin_h = sin_lat * sin_dec + cos_lat * cos_dec * math.cos(ha)
+    return _d(math.asin(max(-1.0, min(1.0, sin_h))))
+
+
+_GRID_STEPS_PER_DAY = 288                    # pas de 5 min
+_GRID_STEPS         = 25 * _GRID_STEPS_PER_DAY // 24   # 25h
+_SUN_CACHE_STEPS    = 2 * _GRID_STEPS_PER_DAY           # 48h, recalculé ~1 fois/jour
+
+
+def sky_grid(jd_now: float, lat: float, lon: float) -> dict:
+    """
+    Grille temporelle commune à tous les objets d'une vérification :
+    25h par pas de 5 min depuis l'échantillon k0 (temps sidéral local, altitude
+    du Soleil) + sin/cos de la latitude et temps sidéral à jd_now.
+    Les échantillons sont calés sur les multiples de 5 min (le premier est le
+    premier à partir de jd_now) pour que ceux du Soleil soient réutilisables
+    d'une exécution à l'autre ; scan10 est l'indice du premier multiple de
+    10 min, d'où part la recherche de fenêtre.
+    """
+    k0 = math.ceil(jd_now * _GRID_STEPS_PER_DAY)
+    lat_r = _r(lat)
+    sin_lat, cos_lat = math.sin(lat_r), math.cos(lat_r)
+    fill_lst = _lst_array if _VECTORIZE else _fill_lst
+    return {
+        "k0":      k0,
+        "scan10":  k0 % 2,
+        "lst":     fill_lst(k0, lon, _buffer(_GRID_STEPS)),
+        "lst_now": (gmst_deg(jd_now) + lon) % 360.0,
+        "sun_alt": _sun_alt_grid(k0, sin_lat, cos_lat, lat, lon),
+        "sin_lat": sin_lat,
+        "cos_lat": cos_lat,
+    }
+
+
+def _buffer(n: int):
+    """Tableau de n flottants (NumPy s'il est installé, liste sinon)."""
+    return np.empty(n) if np is not None else [0.0] * n
+
+
+@njit(cache=True)
+def _fill_lst(k0, lon, out):
+    """Temps sidéral local (degrés) des échantillons k0, k0+1… de la grille."""
+    for i in range(len(out)):
+        out[i] = (gmst_deg((k0 + i) / _GRID_STEPS_PER_DAY) + lon) % 360.0
+    return out
+
+
+@njit(cache=True)
+def _fill_sun_alt(k0, lst, sin_lat, cos_lat, out):
+    """Altitude du Soleil (degrés) des échantillons k0, k0+1… de la grille."""
+    for i in range(len(out)):
+        s_ra, s_dec = sun_pos((k0 + i) / _GRID_STEPS_PER_DAY)
+        out[i] = altitude_fast(s_ra, s_dec, lst[i], sin_lat, cos_lat)
+    return out
+
+
+def _altitude_array(ra_h, dec_d, lst, sin_lat: float, cos_lat: float):
+    """altitude_fast() sur un tableau NumPy de temps sidéraux (objet ou Soleil)."""
+    dec_r = np.radians(dec_d)
+    ha = np.radians((lst - ra_h * 15.0) % 360.0)
+    sin_h = sin_lat * np.sin(dec_r) + cos_lat * np.cos(dec_r) * np.cos(ha)
+    return np.degrees(np.arcsin(np.clip(sin_h, -1.0, 1.0)))
+
+
+def _lst_array(k0, lon, out):
+    """Version vectorisée de _fill_lst()."""
+    out[:] = (gmst_deg(np.arange(k0, k0 + len(out)) / _GRID_STEPS_PER_DAY) + lon) % 360.0
+    return out
+
+
+def _sun_alt_array(k0, lst, sin_lat, cos_lat, out):
+    """Version vectorisée de _fill_sun_alt() (mêmes formules que sun_pos())."""
+    n = np.arange(k0, k0 + len(out)) / _GRID_STEPS_PER_DAY - _J2000
+    L = (280.460 + _SUN_L_RATE * n) % 360.0
+    g = np.radians((357.528 + _SUN_G_RATE * n) % 360.0)
+    lam = np.radians(L + 1.915 * np.sin(g) + 0.020 * np.sin(2 * g))
+    eps = _OBLIQUITY_J2000 - _OBLIQUITY_RATE * n
+    ra  = np.degrees(np.arctan2(np.cos(eps) * np.sin(lam), np.cos(lam))) / 15.0
+    dec = np.degrees(np.arcsin(np.sin(eps) * np.sin(lam)))
+    out[:] = _altitude_array(ra % 24.0, dec, lst, sin_lat, cos_lat)
+    return out
+
+
+def _sun_alt_grid(k0: int, sin_lat: float, cos_lat: float, lat: float, lon: float):
+    """
+    Altitudes du Soleil sur la grille, relues dans sun_cache.json quand il
+    couvre les 25h demandées (même site). Sinon elles sont calculées pour 48h
+    à partir de k0 et le cache est réécrit : les vérifications des ~23h
+    suivantes le relisent sans calcul ni écriture.
+    """
+    try:
+        with open(SUN_CACHE) as f:
+            cache = json.load(f)
+        off = k0 - cache["k0"]
+        if (cache["lat"] == lat and cache["lon"] == lon
+                and 0 <= off and off + _GRID_STEPS <= len(cache["sun_alt"])):
+            sun = _buffer(_GRID_STEPS)
+            sun[:] = cache["sun_alt"][off:off + _GRID_STEPS]
+            return sun
+    except Exception:
+        pass
+
+    fill_lst     = _lst_array if _VECTORIZE else _fill_lst
+    fill_sun_alt = _sun_alt_array if _VECTORIZE else _fill_sun_alt
+    lst = fill_lst(k0, lon, _buffer(_SUN_CACHE_STEPS))
+    sun = fill_sun_alt(k0, lst, sin_lat, cos_lat, _buffer(_SUN_CACHE_STEPS))
+    try:
+        write_json_atomic(SUN_CACHE, {"lat": lat, "lon": lon, "k0": k0,
+                                      "sun_alt": [float(x) for x in sun]})
+    except OSError as e:
+        print(f"[WARN] Écriture de sun_cache.json impossible : {e}", file=sys.stderr)
+    return sun[:_GRID_STEPS]
+
+
+@njit(cache=True)
+def _scan_windows(ra_h, dec_d, lst, sun, first, step, sin_lat, cos_lat,
+                  min_alt, max_sun):
+    """
+    Deux premières fenêtres (début, fin) où le Soleil est sous max_sun et l'objet
+    au-dessus de min_alt, en indices de grille (échantillons first, first+step…).
+    fin = len(lst) pour une fenêtre encore ouverte au bout des 25h.
+    """
+    dec_r = _r(dec_d)
+    dc = (math.sin(dec_r), math.cos(dec_r))
+    windows = []
+    start = -1
+    for i in range(first, len(lst), step):
+        ok = (sun[i] < max_sun
+              and altitude_fast(ra_h, dec_d, lst[i], sin_lat, cos_lat, dc) >= min_alt)
+        if ok and start < 0:
+            start = i
+        elif not ok and start >= 0:
+            windows.append((start, i))
+            start = -1
+            if len(windows) == 2:
+                return windows
+    if start >= 0:
+        windows.append((start, len(lst)))
+    return windows
+
+
+@njit(cache=True)
+def _scan_max_alt(ra_h, dec_d, lst, n, sin_lat, cos_lat):
+    """Altitude max (degrés) sur les n premiers échantillons de la grille."""
+    dec_r = _r(dec_d)
+    dc = (math.sin(dec_r), math.cos(dec_r))
+    best = -90.0
+    for i in range(n):
+        a = altitude_fast(ra_h, dec_d, lst[i], sin_lat, cos_lat, dc)
+        if a > best:
+            best = a
+    return best
+
+
+def _windows_array(ra_h, dec_d, lst, sun, first, step, sin_lat, cos_lat,
+                   min_alt, max_sun):
+    """Version vectorisée de _scan_windows()."""
+    ok = ((sun[first::step] < max_sun)
+          & (_altitude_array(ra_h, dec_d, lst[first::step], sin_lat, cos_lat) >= min_alt))
+    # Fronts montants (+1) / descendants (-1) ; 0 ajouté aux deux bouts pour
+    # fermer une fenêtre ouverte au début ou à la fin des 25h.
+    edges  = np.diff(np.concatenate(([0], ok.astype(np.int8), [0])))
+    starts = (first + step * np.flatnonzero(edges == 1)).tolist()
+    ends   = [min(first + step * e, len(lst)) for e in np.flatnonzero(edges == -1).tolist()]
+    return list(zip(starts, ends))[:2]
+
+
+def _max_alt_array(ra_h, dec_d, lst, n, sin_lat, cos_lat):
+    """Version vectorisée de _scan_max_alt()."""
+    return float(_altitude_array(ra_h, dec_d, lst[:n], sin_lat, cos_lat).max())
+
+
+def observable_window(ra_h: float, dec_d: float, grid: dict,
                       min_alt: float, max_sun: float) -> str:
     """Retourne la première fenêtre d'observabilité dans les 25h (UTC)."""
-    windows, in_w, w_start = [], False, None
-    for step in range(0, 25 * 60, 10):
-        jd = jd0 + step / 1440.0
-        ok = sun_alt(jd, lat, lon) < max_sun and altitude(ra_h, dec_d, jd, lat, lon) >= min_alt
-        if ok and not in_w:
-            in_w, w_start = True, jd
-        elif not ok and in_w:
-            in_w = False
-            windows.append((w_start, jd))
-        if len(windows) >= 2:
-            break
-    if in_w:
-        windows.append((w_start, jd0 + 25 / 24.0))
-
-    if not windows:
+    # Pas de 10 min : un échantillon de la grille sur deux, calé sur les
+    # multiples de 10 min quel que soit k0
+    scan = _windows_array if _VECTORIZE else _scan_windows
+    idx = scan(ra_h, dec_d, grid["lst"], grid["sun_alt"], grid["scan10"], 2,
+               grid["sin_lat"], grid["cos_lat"], min_alt, max_sun)
+    if not idx:
         return "Pas de créneau dans les 25 prochaines heures"
 
-    def fmt(j):
-        frac = (j + 0.5) % 1.0
-        hh, mm = int(frac * 24), int((frac * 24 % 1) * 60)
+    def fmt(i):
+        # Arrondi à la minute : les échantillons tombent sur des minutes rondes
+        j = (grid["k0"] + i) / _GRID_STEPS_PER_DAY
+        hh, mm = divmod(round(((j + 0.5) % 1.0) * 1440) % 1440, 60)
         return f"{hh:02d}:{mm:02d} UTC"
 
-    return " | ".join(f"{fmt(s)} → {fmt(e)}" for s, e in windows[:2])
+    return " | ".join(f"{fmt(s)} → {fmt(e)}" for s, e in idx)
 
 
-def max_alt_24h(ra_h: float, dec_d: float, jd0: float,
-                lat: float, lon: float) -> float:
+def max_alt_24h(ra_h: float, dec_d: float, grid: dict) -> float:
     """Altitude max dans les 24h suivantes (degrés)."""
-    return max(altitude(ra_h, dec_d, jd0 + s / 1440.0, lat, lon)
-               for s in range(0, 24 * 60, 5))
+    scan = _max_alt_array if _VECTORIZE else _scan_max_alt
+    return scan(ra_h, dec_d, grid["lst"], 24 * 12, grid["sin_lat"], grid["cos_lat"])
 
 
 def format_ra(ra_h: float) -> str:
-    h = int(ra_h)
-    m = int((ra_h - h) * 60)
-    s = int(((ra_h - h) * 3600) % 60)
+    # Arrondi à la seconde, 24h 00m 00s repliés sur 00h 00m 00s
+    total_sec = round(ra_h * 3600) % 86400
+    h, rem = divmod(total_sec, 3600)
+    m, s = divmod(rem, 60)
     return f"{h:02d}h {m:02d}m {s:02d}s"
 
 
+# ═══════════════════════════════════════════════════════════════════════════
+# Réseau
+# ═══════════════════════════════════════════════════════════════════════════
+
+# Pool partagé : MPC et webhook Discord réutilisent leur connexion TLS.
+_HTTP = (urllib3.PoolManager(maxsize=10, headers={"User-Agent": USER_AGENT})
+         if urllib3 else None)
+
+
+@contextlib.contextmanager
+def _http_open(method: str, url: str, body: bytes = None,
+               headers: dict = None, timeout: float = 20):
+    """
+    Ouvre une requête HTTP et fournit la réponse (objet fichier, attribut .status).
+    Les codes d'erreur HTTP ne lèvent pas d'exception : à l'appelant de tester .status.
+    """
+    hdrs = {"User-Agent": USER_AGENT, **(headers or {})}
+    if _HTTP is not None:
+        r = _HTTP.request(method, url, body=body, headers=hdrs,
+                          timeout=urllib3.Timeout(connect=5, read=timeout),
+                          preload_content=False)
+        r.auto_close = False    # lisible via io.TextIOWrapper jusqu'à la fin
+        try:
+            yield r
+        finally:
+            r.drain_conn()
+            r.release_conn()
+        return
+
+    req = urllib.request.Request(url, data=body, headers=hdrs, method=method)
+    try:
+        r = urllib.request.urlopen(req, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        r = e
+    with r:
+        yield r
+
+
 # ═══════════════════════════════════════════════════════════════════════════
 # Parsing PCCP
 # ═══════════════════════════════════════════════════════════════════════════
 
-def fetch_pccp() -> list:
-    """Télécharge et parse pccp.txt du MPC."""
+# Ligne pccp.txt : désignation, score, découverte (année mois jour), RA (h),
+# Dec (°), V, « Updated <date> UT », NObs, Arc, H, jours depuis la dernière obs.
+_ROW_RE = re.compile(r"\s*(?P<desig>\S+)\s+(?P<score>\S+)"
+                     r"\s+(?P<year>\S+)\s+(?P<month>\S+)\s+(?P<day>\S+)"
+                     r"\s+(?P<ra_h>\S+)\s+(?P<dec_d>\S+)\s+(?P<mag>\S+)")
+_UPDATED_RE = re.compile(r"Updated\s+(\S.*?)\s*UT")
+
+
+class PccpObject(NamedTuple):
+    """Une ligne de pccp.txt."""
+    desig:   str
+    score:   str
+    disc:    str
+    ra_h:    float
+    dec_d:   float
+    mag:     float
+    updated: str
+    nobs:    Optional[int]
+    arc:     Optional[float]
+
+
+def _parse_row(line: str):
+    """Parse une ligne de pccp.txt ; None si la ligne n'est pas un objet."""
+    m = _ROW_RE.match(line)
+    if not m:
+        return None
     try:
-        req = urllib.request.Request(PCCP_URL,
-                                     headers={"User-Agent": "CometWatch-R85/1.1"})
-        with urllib.request.urlopen(req, timeout=20) as r:
-            raw = r.read().decode("utf-8", errors="replace")
-    except Exception as e:
-        print(f"[ERROR] Impossible de récupérer pccp.txt : {e}", file=sys.stderr)
-        return []
+        ra_h  = float(m["ra_h"])
+        dec_d = float(m["dec_d"])
+        mag   = float(m["mag"])
+    except ValueError:
+        return None
+    disc = f"{m['year']}-{m['month']}-{m['day']}"
+    u = _UPDATED_RE.search(line, m.end())
+    # Espaces / tabulations multiples ramenés à un seul espace
+    updated = f"{' '.join(u.group(1).split())} UT" if u else ""
+    # NObs et Arc sont les 4e et 3e champs en partant de la fin
+    try:
+        _, nobs, arc, _, _ = line.rsplit(None, 4)
+        nobs, arc = int(nobs), float(arc)
+    except ValueError:
+        nobs, arc = None, None
+    return PccpObject(desig=m["desig"], score=m["score"],
+                      disc=disc, ra_h=ra_h, dec_d=dec_d,
+                      mag=mag, updated=updated,
+                      nobs=nobs, arc=arc)
+
+
+class PccpFetch:
+    """
+    Téléchargement de pccp.txt du MPC. Itérer produit les objets au fil du décodage.
+    etag, last_modified : validateurs de la réponse précédente, envoyés en
+    requête conditionnelle puis remplacés par ceux de la nouvelle réponse.
+    En fin d'itération, status vaut :
+      200  : corps reçu en entier (connexion terminée sans erreur et, avec
+             urllib, aucun octet manquant par rapport au Content-Length) ;
+      304  : fichier inchangé, rien n'est produit ;
+      None : erreur, y compris corps tronqué — les objets déjà produits peuvent
+             être incomplets et doivent être ignorés.
+    """
+
+    def __init__(self, etag: Optional[str] = None, last_modified: Optional[str] = None):
+        self.etag          = etag
+        self.last_modified = last_modified
+        self.status        = None
+
+    def __iter__(self):
+        self.status = None
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
 
-    objects = []
-    for line in raw.splitlines():
-        parts = line.split()
-        if len(parts) < 8:
-            continue
         try:
-            ra_h  = float(parts[5])
-            dec_d = float(parts[6])
-            mag   = float(parts[7])
-            disc  = f"{parts[2]}-{parts[3]}-{parts[4]}"
-            i = line.find("Updated")
-            updated = (line[i:].split("UT")[0].replace("Updated", "").strip() + " UT"
-                       if i >= 0 else "")
-            # NObs et Arc sont les 4e et 3e champs en partant de la fin
-            try:
-                nobs = int(parts[-4])
-                arc  = float(parts[-3])
-            except (ValueError, IndexError):
-                nobs, arc = None, None
-            objects.append(dict(desig=parts[0], score=parts[1],
-                                disc=disc, ra_h=ra_h, dec_d=dec_d,
-                                mag=mag, updated=updated,
-                                nobs=nobs, arc=arc))
-        except (ValueError, IndexError):
-            continue
-    return objects
+            with _http_open("GET", PCCP_URL, headers=headers, timeout=20) as r:
+                if r.status == 304:
+                    self.status = 304
+                    return
+                if r.status != 200:
+                    raise OSError(f"HTTP {r.status}")
+                etag, last_modified = r.headers.get("ETag"), r.headers.get("Last-Modified")
+                text = io.TextIOWrapper(r, encoding="utf-8", errors="replace")
+                for line in text:
+                    obj = _parse_row(line)
+                    if obj is not None:
+                        yield obj
+                text.detach()   # la réponse est fermée/rendue au pool par _http_open
+                # urllib ne lève rien sur une connexion coupée avant Content-Length
+                # (urllib3 si) : il reste alors des octets attendus dans r.length.
+                if getattr(r, "length", None):
+                    raise http.client.IncompleteRead(b"", r.length)
+        except Exception as e:
+            print(f"[ERROR] Impossible de récupérer pccp.txt : {e}", file=sys.stderr)
+            return
+        self.etag, self.last_modified, self.status = etag, last_modified, 200
 
 
 # ═══════════════════════════════════════════════════════════════════════════
 # État persistant
 # ═══════════════════════════════════════════════════════════════════════════
 
-def load_state() -> dict:
-    if os.path.exists(STATE_FILE):
+def open_state() -> sqlite3.Connection:
+    """
+    Ouvre la base d'état (créée au besoin) :
+      known(desig, first_seen) : objets actuellement sur la PCCP
+      meta(key, value)         : last_check, …
+    Un ancien state.json est importé à la création puis renommé en .bak.
+    """
+    created = not os.path.exists(STATE_DB)
+    db = sqlite3.connect(STATE_DB, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS known (desig TEXT PRIMARY KEY, first_seen TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    if created and os.path.exists(STATE_FILE):
         try:
             with open(STATE_FILE) as f:
-                return json.load(f)
-        except Exception:
-            pass
-    return {"known": [], "last_check": None}
+                old = json.load(f)
+            db.executemany("INSERT OR IGNORE INTO known(desig, first_seen) VALUES (?, ?)",
+                           [(d, old.get("last_check")) for d in old.get("known", [])])
+            if old.get("last_check"):
+                set_meta(db, "last_check", old["last_check"])
+            os.replace(STATE_FILE, STATE_FILE + ".bak")
+        except Exception as e:
+            print(f"[WARN] Import de state.json impossible : {e}", file=sys.stderr)
+    return db
+
+
+def write_json_atomic(path: str, data):
+    """Écrit un fichier JSON via un .tmp renommé : jamais de fichier tronqué."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+def touch(path: str):
+    if os.path.exists(path):
+        os.utime(path)
+    else:
+        open(path, "w").close()
+
 
+def load_known(db: sqlite3.Connection) -> set:
+    return {row[0] for row in db.execute("SELECT desig FROM known")}
 
-def save_state(s: dict):
-    with open(STATE_FILE, "w") as f:
-        json.dump(s, f, indent=2)
+
+def update_known(db: sqlite3.Connection, current: set, known: set, time_str: str):
+    """Aligne la table known sur la PCCP courante (ajouts + retraits)."""
+    db.execute("BEGIN")
+    db.executemany("INSERT OR IGNORE INTO known(desig, first_seen) VALUES (?, ?)",
+                   [(d, time_str) for d in current - known])
+    db.executemany("DELETE FROM known WHERE desig = ?",
+                   [(d,) for d in known - current])
+    db.execute("COMMIT")
+
+
+def get_meta(db: sqlite3.Connection, key: str, default=None):
+    row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_meta(db: sqlite3.Connection, key: str, value):
+    db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, value))
 
 
 # ═══════════════════════════════════════════════════════════════════════════
 # Notifications macOS
 # ═══════════════════════════════════════════════════════════════════════════
 
+def _escape_applescript(s: str) -> str:
+    return s.replace("\\", "\\\\").replace('"', '\\"')
+
+
 def notify_macos(title: str, body: str, subtitle: str = "", sound: str = "Glass"):
     """Envoie une notification Notification Center via osascript."""
     if platform.system() != "Darwin":
         return
-    parts = [f'display notification "{body}"', f'with title "{title}"']
+    esc = _escape_applescript
+    parts = [f'display notification "{esc(body)}"', f'with title "{esc(title)}"']
     if subtitle:
-        parts.append(f'subtitle "{subtitle}"')
+        parts.append(f'subtitle "{esc(subtitle)}"')
     if sound:
-        parts.append(f'sound name "{sound}"')
+        parts.append(f'sound name "{esc(sound)}"')
     try:
-        subprocess.run(["osascript", "-e", " ".join(parts)],
+        # Script lu sur stdin : pas de limite de longueur d'argv
+        subprocess.run(["osascript", "-"], input=" ".join(parts), text=True,
                        check=False, capture_output=True, timeout=5)
     except Exception as e:
         print(f"[WARN] Notification macOS : {e}", file=sys.stderr)
@@ -310,26 +693,33 @@ def notify_discord(cfg: dict, objects_info: list, time_str: str):
         })
 
     # Discord limite à 10 embeds par message
-    for i in range(0, len(embeds), 10):
-        payload = {"embeds": embeds[i:i+10]}
-        if mention and i == 0:
-            payload["content"] = mention
-        data = json.dumps(payload).encode("utf-8")
-        try:
-            req = urllib.request.Request(
-                webhook_url,
-                data=data,
-                headers={"Content-Type": "application/json",
-                         "User-Agent": "CometWatch-R85/1.1"},
-                method="POST",
-            )
-            with urllib.request.urlopen(req, timeout=10) as r:
-                status = r.status
-                if status not in (200, 204):
-                    print(f"[WARN] Discord webhook réponse inattendue : {status}",
-                          file=sys.stderr)
-        except Exception as e:
-            print(f"[ERROR] Discord webhook : {e}", file=sys.stderr)
+    payloads = [{"embeds": embeds[i:i+10]} for i in range(0, len(embeds), 10)]
+    if not payloads:
+        return
+    if mention:
+        payloads[0]["content"] = mention
+
+    # Le message avec la mention part en premier, les suivants en parallèle
+    _post_discord(webhook_url, payloads[0])
+    rest = payloads[1:]
+    if rest:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(4, len(rest))) as ex:
+            list(ex.map(lambda p: _post_discord(webhook_url, p), rest))
+
+
+def _post_discord(webhook_url: str, payload: dict):
+    """POST d'un message (≤ 10 embeds) sur le webhook Discord."""
+    data = json.dumps(payload).encode("utf-8")
+    try:
+        with _http_open("POST", webhook_url, body=data,
+                        headers={"Content-Type": "application/json"},
+                        timeout=10) as r:
+            status = r.status
+            if status not in (200, 204):
+                print(f"[WARN] Discord webhook réponse inattendue : {status}",
+                      file=sys.stderr)
+    except Exception as e:
+        print(f"[ERROR] Discord webhook : {e}", file=sys.stderr)
 
 
 # ═══════════════════════════════════════════════════════════════════════════
@@ -355,93 +745,110 @@ def main():
                    else "nuit nautique" if is_night
                    else "crépuscule/jour")
 
-    # ── Récupération PCCP ───────────────────────────────────────────────
-    objects = fetch_pccp()
-    if not objects:
+    # ── Récupération PCCP (conditionnelle) + détection au fil de l'eau ──
+    db    = open_state()
+    known = load_known(db)
+    # État vide : téléchargement complet, même si des validateurs traînent
+    pccp  = (PccpFetch(get_meta(db, "pccp_etag"), get_meta(db, "pccp_last_modified"))
+             if known else PccpFetch())
+
+    grid           = None # grille temporelle, calculée au 1er objet assez brillant
+    current        = set()
+    new_count      = 0
+    new_lines      = []   # section « nouveaux objets » du rapport
+    alert_objects  = []   # désignations à notifier
+    discord_embeds = []   # données pour Discord
+
+    for obj in pccp:
+        is_new = obj.desig not in known and obj.desig not in current
+        current.add(obj.desig)
+        if not is_new:
+            continue
+        new_count += 1
+
+        ra_h, dec_d, mag = obj.ra_h, obj.dec_d, obj.mag
+        new_lines += [
+            f"\n• Désignation : {obj.desig}",
+            f"  Score PCCP   : {obj.score}%",
+            f"  Découverte   : {obj.disc}",
+            f"  Mise à jour  : {obj.updated}",
+            f"  Position     : RA {format_ra(ra_h)}  Dec {dec_d:+.2f}°",
+            f"  Magnitude    : {mag:.1f}",
+            f"  Observations : {obj.nobs}  (arc : {obj.arc} j)",
+        ]
+
+        # Trop faible : inutile de calculer altitude et fenêtre
+        if mag > max_mag:
+            new_lines.append(f"  🔴 Non observable : trop faible "
+                             f"(mag {mag:.1f} > limite {max_mag})")
+            continue
+
+        if grid is None:
+            grid = sky_grid(jd_now, lat, lon)
+        alt_now = altitude_fast(ra_h, dec_d, grid["lst_now"],
+                                grid["sin_lat"], grid["cos_lat"])
+        mx_alt  = max_alt_24h(ra_h, dec_d, grid)
+
+        obs_now     = is_night and alt_now >= min_alt
+        obs_tonight = mx_alt >= min_alt
+
+        new_lines.append(f"  Altitude now : {alt_now:.1f}°  (max 24h : {mx_alt:.1f}°)")
+
+        window = ""
+        if obs_now:
+            new_lines.append("  🟢 OBSERVABLE MAINTENANT depuis R85 !")
+            window = "Actuellement observable"
+            alert_objects.append(obj.desig)
+            discord_embeds.append({**obj._asdict(), "alt_now": alt_now, "max_alt": mx_alt,
+                                   "obs_now": True, "window": window})
+        elif obs_tonight:
+            window = observable_window(ra_h, dec_d, grid, min_alt, max_sun)
+            new_lines.append(f"  🟡 Observable ce soir → {window}")
+            alert_objects.append(obj.desig)
+            discord_embeds.append({**obj._asdict(), "alt_now": alt_now, "max_alt": mx_alt,
+                                   "obs_now": False, "window": window})
+        else:
+            new_lines.append(f"  🔴 Non observable : jamais > {min_alt}° (max {mx_alt:.1f}°)")
+            # ← pas d'ajout à discord_embeds : objet ignoré dans Discord
+
+    if pccp.status == 304:
+        # Même fichier qu'à la dernière vérification, aucun nouvel objet possible
+        set_meta(db, "last_check", time_str)
+        db.close()
+        print(f"🔭 PCCP Comet Watch R85 | {time_str}\n"
+              f"☀️  Soleil : {s_alt:.1f}° ({night_label})\n"
+              f"📋 Total PCCP : {len(known)} objet(s) | 🆕 Nouveaux : 0\n\n"
+              f"✓ pccp.txt inchangé depuis la dernière vérification.")
+        return
+    if pccp.status != 200 or not current:
+        # status ≠ 200 : erreur ou corps tronqué (cf. PccpFetch). Les lignes du
+        # rapport et les embeds déjà préparés à partir des objets reçus sont
+        # abandonnés : rien n'est enregistré ni notifié.
+        db.close()
         print(f"[{time_str}] Aucun objet récupéré (erreur réseau ?).")
         return
 
-    # ── Détection nouveaux objets ────────────────────────────────────────
-    state      = load_state()
-    known      = set(state.get("known", []))
-    current    = {o["desig"] for o in objects}
-    new_desigs = current - known
-    first_run  = len(known) == 0
-
-    state["known"] = list(current)
-    state["last_check"] = time_str
-    save_state(state)
+    # Écriture seulement si la liste a changé (cas rare d'une heure à l'autre)
+    if current != known:
+        update_known(db, current, known, time_str)
+    set_meta(db, "last_check", time_str)
+    set_meta(db, "pccp_etag", pccp.etag)
+    set_meta(db, "pccp_last_modified", pccp.last_modified)
+    db.close()
 
     # ── Rapport texte ────────────────────────────────────────────────────
     lines = [
         f"🔭 PCCP Comet Watch R85 | {time_str}",
         f"☀️  Soleil : {s_alt:.1f}° ({night_label})",
-        f"📋 Total PCCP : {len(objects)} objet(s) | 🆕 Nouveaux : {len(new_desigs)}",
+        f"📋 Total PCCP : {len(current)} objet(s) | 🆕 Nouveaux : {new_count}",
         "",
     ]
 
-    alert_objects  = []   # désignations à notifier
-    discord_embeds = []   # données pour Discord
-
-    if new_desigs:
+    if new_count:
         lines += ["═" * 50, "🆕 NOUVEAUX OBJETS SUR LA PCCP", "═" * 50]
-
-        for obj in objects:
-            if obj["desig"] not in new_desigs:
-                continue
-
-            ra_h, dec_d, mag = obj["ra_h"], obj["dec_d"], obj["mag"]
-            alt_now = altitude(ra_h, dec_d, jd_now, lat, lon)
-            mx_alt  = max_alt_24h(ra_h, dec_d, jd_now, lat, lon)
-
-            obs_now     = is_night and alt_now >= min_alt and mag <= max_mag
-            obs_tonight = mx_alt >= min_alt and mag <= max_mag
-
-            lines += [
-                f"\n• Désignation : {obj['desig']}",
-                f"  Score PCCP   : {obj['score']}%",
-                f"  Découverte   : {obj['disc']}",
-                f"  Mise à jour  : {obj['updated']}",
-                f"  Position     : RA {format_ra(ra_h)}  Dec {dec_d:+.2f}°",
-                f"  Magnitude    : {mag:.1f}",
-                f"  Observations : {obj.get('nobs', '?')}  (arc : {obj.get('arc', '?')} j)",
-                f"  Altitude now : {alt_now:.1f}°  (max 24h : {mx_alt:.1f}°)",
-            ]
-
-            window = ""
-            if obs_now:
-                lines.append("  🟢 OBSERVABLE MAINTENANT depuis R85 !")
-                window = "Actuellement observable"
-                alert_objects.append(obj["desig"])
-                discord_embeds.append({**obj, "alt_now": alt_now, "max_alt": mx_alt,
-                                       "obs_now": True, "window": window})
-            elif obs_tonight:
-                window = observable_window(ra_h, dec_d, jd_now, lat, lon, min_alt, max_sun)
-                lines.append(f"  🟡 Observable ce soir → {window}")
-                alert_objects.append(obj["desig"])
-                discord_embeds.append({**obj, "alt_now": alt_now, "max_alt": mx_alt,
-                                       "obs_now": False, "window": window})
-            else:
-                reasons = []
-                if mag > max_mag:
-                    reasons.append(f"trop faible (mag {mag:.1f} > limite {max_mag})")
-                if mx_alt < min_alt:
-                    reasons.append(f"jamais > {min_alt}° (max {mx_alt:.1f}°)")
-                lines.append(f"  🔴 Non observable : {', '.join(reasons)}")
-                # ← pas d'ajout à discord_embeds : objet ignoré dans Discord
-
+        lines += new_lines
         lines += ["", f"🔗 {PCCP_PAGE}"]
 
-    elif first_run:
-        lines.append("📋 Liste initiale (premier lancement) :")
-        for obj in objects:
-            a   = altitude(obj["ra_h"], obj["dec_d"], jd_now, lat, lon)
-            mx  = max_alt_24h(obj["ra_h"], obj["dec_d"], jd_now, lat, lon)
-            ico = ("🟢" if (is_night and a >= min_alt and obj["mag"] <= max_mag)
-                   else "🟡" if (mx >= min_alt and obj["mag"] <= max_mag) else "🔴")
-            nobs_str = f"  nobs={obj.get('nobs', '?')}" if obj.get('nobs') is not None else ""
-            lines.append(f"  {ico} {obj['desig']}  mag={obj['mag']:.1f}  alt={a:.1f}°{nobs_str}")
-        lines.append("\n✅ État initial enregistré. Surveillance active toutes les heures.")
     else:
         lines.append("✓ Aucun nouvel objet depuis la dernière vérification.")
 
@@ -451,9 +858,9 @@ def main():
     # ── Notifications ────────────────────────────────────────────────────
     if alert_objects:
         # Fichier d'alerte (heartbeat OpenClaw)
-        with open(ALERT_FILE, "w") as f:
-            json.dump({"time": time_str, "objects": alert_objects, "report": report}, f, indent=2)
-        open(FLAG_FILE, "w").close()
+        write_json_atomic(ALERT_FILE, {"time": time_str, "objects": alert_objects,
+                                       "report": report})
+        touch(FLAG_FILE)
 
         count    = len(alert_objects)
         plural_e = "s" if count > 1 else ""